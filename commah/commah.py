@@ -5,7 +5,12 @@
 
 from __future__ import absolute_import, division, print_function
 
+import functools
+import multiprocessing
+import numbers
+
 import scipy
+import scipy.interpolate
 import numpy as np
 import cosmolopy as cp
 import commah.cosmology_list as cg
@@ -13,26 +18,47 @@ import commah.cosmology_list as cg
 __author__ = 'Camila Correa and Alan Duffy'
 __email__ = 'mail@alanrduffy.com'
 
-def _izip(*iterables):
-    # zip('ABCD', 'xy') --> Ax By
-    sentinel = object()
-    iterators = [iter(it) for it in iterables]
-    while iterators:
-        result = []
-        for it in iterators:
-            elem = next(it, sentinel)
-            if elem is sentinel:
-                return
-            result.append(elem)
-        yield tuple(result)
+def _memoize(maxsize=4096):
+    """ Cache the return values of a function, emptying the cache once it
+        holds more than 'maxsize' entries. Calls with unhashable arguments
+        are passed straight through without caching """
+
+    def decorator(func):
+        cache = {}
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            try:
+                return(cache[args])
+            except KeyError:
+                if len(cache) >= maxsize:
+                    cache.clear()
+                value = cache[args] = func(*args)
+                return(value)
+            except TypeError:
+                # Unhashable arguments, e.g. NumPy array cosmology values
+                return(func(*args))
+
+        wrapper.cache = cache
+        return(wrapper)
+
+    return(decorator)
+
+
+def _as1d(x):
+    """ Convert any input scalar or array to an (at least) 1D float NumPy
+        array, without copying if it already is one """
+
+    return(np.atleast_1d(np.asarray(x, dtype=float)))
+
 
 def _checkinput(zi, Mi, z=False, verbose=None):
     """ Check and convert any input scalar or array to numpy array """
     # How many halo redshifts provided?
-    zi = np.array(zi, ndmin=1, dtype=float)
+    zi = _as1d(zi)
 
     # How many halo masses provided?
-    Mi = np.array(Mi, ndmin=1, dtype=float)
+    Mi = _as1d(Mi)
 
     # Check the input sizes for zi and Mi make sense, if not then exit unless
     # one axis is length one, then replicate values to the size of the other
@@ -63,7 +89,7 @@ def _checkinput(zi, Mi, z=False, verbose=None):
         lenzout = 1
     else:
         # If something was passed, convert to 1D NumPy array
-        z = np.array(z, ndmin=1, dtype=float)
+        z = _as1d(z)
         lenzout = z.size
 
     return(zi, Mi, z, zi.size, Mi.size, lenzout)
@@ -72,6 +98,37 @@ def _checkinput(zi, Mi, z=False, verbose=None):
 def getcosmo(cosmology):
     """ Find cosmological parameters for named cosmo in cosmology.py list """
 
+    if isinstance(cosmology, dict):
+        cosmo = _getcosmo_cached(_cosmo_key(cosmology))
+        # User dict gets filled in with the extra variables as before
+        cosmology.update(cosmo)
+        # File it under the filled in dict too, so passing the same dict
+        # again finds it rather than assembling it a second time
+        try:
+            _getcosmo_cached.cache.setdefault((_cosmo_key(cosmology),), cosmo)
+        except TypeError:
+            pass
+    else:
+        cosmo = _getcosmo_cached(cosmology.lower())
+
+    # Copy so that callers can't modify the cached cosmology
+    return(dict(cosmo))
+
+
+@_memoize(maxsize=64)
+def _getcosmo_cached(cosmo_key):
+    """ Assembled cosmology for a lower case name, or for the sorted items of
+        a user dict, built only once for each """
+
+    if isinstance(cosmo_key, tuple):
+        return(_assemblecosmo(dict(cosmo_key)))
+    else:
+        return(_assemblecosmo(cosmo_key))
+
+
+def _assemblecosmo(cosmology):
+    """ Build the dict of cosmological parameters passed as **cosmo """
+
     defaultcosmologies = {'dragons': cg.DRAGONS(), 'wmap1': cg.WMAP1_Mill(),
                           'wmap3': cg.WMAP3_ML(), 'wmap5': cg.WMAP5_mean(),
                           'wmap7': cg.WMAP7_ML(), 'wmap9': cg.WMAP9_ML(),
@@ -111,6 +168,7 @@ def getcosmo(cosmology):
         cosmo.update({'baryonic_effects': True})
     else:
         cosmo.update({'baryonic_effects': False})
+
     # Use the cosmology as **cosmo passed to cosmolopy routines
     return(cosmo)
 
@@ -126,27 +184,25 @@ def _getcosmoheader(cosmo):
     return(cosmoheader)
 
 
+# Duffy et al. (2008) Table 1 parameters (A, B, C) of the NFW concentration
+# c = A * (M / Mpivot)**B * (1 + z)**C for each (halo boundary, relaxed)
+_DUFFY_PARAMS = {('200crit', True): (6.71, -0.091, -0.44),
+                 ('200crit', False): (5.71, -0.084, -0.47),
+                 ('tophat', True): (9.23, -0.090, -0.69),
+                 ('tophat', False): (7.85, -0.081, -0.71),
+                 ('200mean', True): (11.93, -0.090, -0.99),
+                 ('200mean', False): (10.14, -0.081, -1.01)}
+
+
 def cduffy(z, M, vir='200crit', relaxed=True):
     """ NFW conc from Duffy 08 Table 1 for halo mass and redshift"""
 
-    if(vir == '200crit'):
-        if relaxed:
-            params = [6.71, -0.091, -0.44]
-        else:
-            params = [5.71, -0.084, -0.47]
-    elif(vir == 'tophat'):
-        if relaxed:
-            params = [9.23, -0.090, -0.69]
-        else:
-            params = [7.85, -0.081, -0.71]
-    elif(vir == '200mean'):
-        if relaxed:
-            params = [11.93, -0.090, -0.99]
-        else:
-            params = [10.14, -0.081, -1.01]
-    else:
+    try:
+        params = _DUFFY_PARAMS[(vir, bool(relaxed))]
+    except KeyError:
         print("Didn't recognise the halo boundary definition provided %s"
               % (vir))
+        raise
 
     return(params[0] * ((M/(2e12/0.72))**params[1]) * ((1+z)**params[2]))
 
@@ -223,23 +279,41 @@ def getAscaling(cosmology, newcosmo=None):
     return(A_scaling)
 
 
+def _growth_integrand(z, omega_M_0, omega_lambda_0):
+    """ Integrand of the linear growth factor """
+
+    return((1 + z)/(omega_M_0*(1 + z)**3 + omega_lambda_0)**(1.5))
+
+
+@_memoize()
+def _int_growth_spline(omega_M_0, omega_lambda_0, zmax=200, nz=400):
+    """ Cubic spline of the integral of the linear growth factor from
+        z=zmax to z=z as a function of log(1+z), tabulated once per cosmology
+        by integrating piecewise between the spline nodes """
+
+    lnz = np.linspace(0, np.log(1 + zmax), nz)
+    znodes = np.expm1(lnz)
+
+    pieces = [scipy.integrate.quad(_growth_integrand, zlo, zhi,
+                                   args=(omega_M_0, omega_lambda_0))[0]
+              for zlo, zhi in zip(znodes[:-1], znodes[1:])]
+    y = np.append(np.cumsum(pieces[::-1])[::-1], 0)
+
+    return(scipy.interpolate.InterpolatedUnivariateSpline(lnz, y, k=3))
+
+
 def _int_growth(z, **cosmo):
     """ Returns integral of the linear growth factor from z=200 to z=z """
 
     zmax = 200
 
-    if hasattr(z, "__len__"):
-        for zval in z:
-            assert(zval < zmax)
-    else:
-        assert(z < zmax)
+    assert(np.all(np.less(z, zmax)))
 
-    y, yerr = scipy.integrate.quad(
-        lambda z: (1 + z)/(cosmo['omega_M_0']*(1 + z)**3 +
-                           cosmo['omega_lambda_0'])**(1.5),
-        z, zmax)
+    spline = _int_growth_spline(cosmo['omega_M_0'], cosmo['omega_lambda_0'],
+                                zmax)
+    y = spline(np.log1p(z))
 
-    return(y)
+    return(y if np.ndim(z) else float(y))
 
 
 def _deriv_growth(z, **cosmo):
@@ -249,14 +323,18 @@ def _deriv_growth(z, **cosmo):
     inv_h = (cosmo['omega_M_0']*(1 + z)**3 + cosmo['omega_lambda_0'])**(-0.5)
     fz = (1 + z) * inv_h**3
 
-    deriv_g = growthfactor(z, norm=True, **cosmo)*(inv_h**2) *\
+    # Normalised growth factor, written out to reuse the integral at z
+    int_growth = _int_growth(z, **cosmo)
+    growthval = int_growth / (inv_h * _int_growth(0, **cosmo))
+
+    deriv_g = growthval*(inv_h**2) *\
         1.5 * cosmo['omega_M_0'] * (1 + z)**2 -\
-        fz * growthfactor(z, norm=True, **cosmo)/_int_growth(z, **cosmo)
+        fz * growthval/int_growth
 
     return(deriv_g)
 
 
-def growthfactor(z, norm=True, **cosmo):
+def growthfactor(z, norm=True, E2=None, **cosmo):
     """ Returns linear growth factor at a given redshift, normalised to z=0
         by default, for a given cosmology
 
@@ -267,6 +345,9 @@ def growthfactor(z, norm=True, **cosmo):
         The redshift at which the growth factor should be calculated
     norm : boolean, optional
         If true then normalise the growth factor to z=0 case defaults True
+    E2 : float / numpy array, optional
+        Squared dimensionless Hubble rate omega_M_0*(1+z)**3 + omega_lambda_0
+        at 'z', if already known. Default is None, calculated here.
     cosmo : dict
         Dictionary of cosmological parameters, similar in format to:
         {'N_nu': 0,'Y_He': 0.24, 'h': 0.702, 'n': 0.963,'omega_M_0': 0.275,
@@ -282,8 +363,9 @@ def growthfactor(z, norm=True, **cosmo):
     ------
 
     """
-    H = np.sqrt(cosmo['omega_M_0'] * (1 + z)**3 +
-                cosmo['omega_lambda_0'])
+    if E2 is None:
+        E2 = cosmo['omega_M_0'] * (1 + z)**3 + cosmo['omega_lambda_0']
+    H = np.sqrt(E2)
     growthval = H * _int_growth(z, **cosmo)
     if norm:
         growthval /= _int_growth(0, **cosmo)
@@ -291,34 +373,216 @@ def growthfactor(z, norm=True, **cosmo):
     return(growthval)
 
 
+def _cosmo_key(cosmo):
+    """ Hashable key identifying a cosmology for the memoised functions """
+
+    return(tuple(sorted(cosmo.items())))
+
+
+@_memoize(maxsize=16)
+def _norm_power(cosmo_key):
+    """ Normalisation 'deltaSqr' of the power spectrum for a cosmology,
+        integrated only once for each """
+
+    return(cp.perturbation.norm_power(**dict(cosmo_key)))
+
+
+def _normed(cosmo):
+    """ Cosmology with the power spectrum normalisation cosmolopy needs,
+        kept out of any dict a caller can get back, as cosmolopy would
+        use a stored 'deltaSqr' even after e.g. sigma_8 is changed """
+
+    if 'deltaSqr' in cosmo:
+        return(cosmo)
+
+    return(dict(cosmo, deltaSqr=_norm_power(_cosmo_key(cosmo))))
+
+
+def _sigma_r0_trapz(R, kmin=1e-6, kmax=1e6, nk=4096, **cosmo):
+    """ Mass variance 'sigma' at z=0 of spheres of radius 'R' [Mpc], from
+        the trapezium rule on one grid in ln(k) shared by every radius """
+
+    lnk, dlnk = np.linspace(np.log(kmin), np.log(kmax), nk, retstep=True)
+    k = np.exp(lnk)
+    # Dimensionless power spectrum k^3 P(k) / (2 pi^2), once for all radii
+    Delta2 = cp.perturbation.power_spectrum(k, 0.0, **_normed(cosmo)) *\
+        k**3 / (2 * np.pi**2)
+
+    # Top-hat window in Fourier space for every radius and wavenumber,
+    # a block of radii at a time so that the (R, k) arrays stay small
+    R = _as1d(R).ravel()
+    sig2 = np.empty(R.size)
+    for i_ind in range(0, R.size, 256):
+        kR = np.outer(R[i_ind:i_ind+256], k)
+        W = 3 * (np.sin(kR) - kR * np.cos(kR)) / kR**3
+
+        integrand = Delta2 * W**2
+        ends = integrand[:, 0] + integrand[:, -1]
+        sig2[i_ind:i_ind+256] = dlnk * (np.sum(integrand, axis=-1) - ends/2)
+
+    return(np.sqrt(sig2))
+
+
+@_memoize(maxsize=16)
+def _sigma_r0_spline(cosmo_key, Rmin=1e-3, Rmax=100, nR=200):
+    """ Cubic spline of ln(sigma) at z=0 against ln(R) for radii from 'Rmin'
+        to 'Rmax' [Mpc], tabulated once per cosmology """
+
+    lnR = np.linspace(np.log(Rmin), np.log(Rmax), nR)
+    sig = _sigma_r0_trapz(np.exp(lnR), **dict(cosmo_key))
+
+    return(scipy.interpolate.InterpolatedUnivariateSpline(lnR, np.log(sig),
+                                                          k=3))
+
+
+def _sigma_r0(R, **cosmo):
+    """ Mass variance 'sigma' at z=0 of spheres of radius 'R' [Mpc],
+        interpolated from a table for the cosmology where possible """
+
+    spline = _sigma_r0_spline(_cosmo_key(cosmo))
+    lnR_min, lnR_max = spline.get_knots()[[0, -1]]
+
+    R_array = _as1d(R)
+    lnR = np.log(R_array)
+    sig = np.exp(spline(lnR))
+
+    # Integrate directly for any radii beyond the table, in the same way
+    # so that sigma(R) and sigma(R/q) of one halo always agree
+    outside = (lnR < lnR_min) | (lnR > lnR_max)
+    if np.any(outside):
+        sig[outside] = _sigma_r0_trapz(R_array[outside], **cosmo)
+
+    sig = np.reshape(sig, np.shape(R))
+
+    return(sig if np.ndim(R) else float(sig))
+
+
+# Y(1) = ln(2) - 1/2 of the NFW mass profile Y(x) = ln(1+x) - x/(1+x)
+_Y1 = np.log(2) - 0.5
+
+
 def _minimize_c(c, z=0, a_tilde=1, b_tilde=-1,
-                Ascaling=900, omega_M_0=0.25, omega_lambda_0=0.75):
+                Ascaling=900, omega_M_0=0.25, omega_lambda_0=0.75,
+                return_zf=False):
     """ Trial function to solve 2 eqns (17 and 18) from Correa et al. (2015c)
-        for 1 unknown, i.e. concentration, returned by a minimisation call """
+        for 1 unknown, i.e. concentration, returned by a minimisation call.
+        If return_zf is True then the formation redshift is also returned """
 
     # Fn 1 (LHS of Eqn 18)
 
-    Y1 = np.log(2) - 0.5
     Yc = np.log(1+c) - c/(1+c)
-    f1 = Y1/Yc
+    f1 = _Y1/Yc
 
     # Fn 2 (RHS of Eqn 18)
 
     # Eqn 14 - Define the mean inner density
-    rho_2 = 200 * c**3 * Y1 / Yc
+    rho_2 = 200 * c**3 * f1
 
     # Eqn 17 rearranged to solve for Formation Redshift
     # essentially when universe had rho_2 density
-    zf = (((1 + z)**3 + omega_lambda_0/omega_M_0) *
-          (rho_2/Ascaling) - omega_lambda_0/omega_M_0)**(1/3) - 1
+    ol_om = omega_lambda_0/omega_M_0
+    zf = (((1 + z)**3 + ol_om) * (rho_2/Ascaling) - ol_om)**(1/3) - 1
 
     # RHS of Eqn 19
-    f2 = ((1 + zf - z)**a_tilde) * np.exp((zf - z) * b_tilde)
+    dzf = zf - z
+    f2 = ((1 + dzf)**a_tilde) * np.exp(dzf * b_tilde)
 
     # LHS - RHS should be zero for the correct concentration
+    if return_zf:
+        return(f1-f2, zf)
     return(f1-f2)
 
 
+def _rho_2(c):
+    """ Mean inner density rho_2 of Eqn 14 in units of the critical density,
+        for NFW haloes of concentration 'c' """
+
+    return(200 * c**3 * _Y1 / (np.log(1+c) - c/(1+c)))
+
+
+def _solve_c(z, a_tilde, b_tilde, Ascaling=900, omega_M_0=0.25,
+             omega_lambda_0=0.75, clim=(2, 1000), tol=1e-8, maxiter=100):
+    """ Vectorised root find of _minimize_c for the concentration of every
+        halo at once, using Newton steps safeguarded by bisection so that
+        each trial concentration stays within the bracket 'clim'. Haloes
+        with no root inside the bracket are returned as NaN """
+
+    z, a_tilde, b_tilde = np.broadcast_arrays(np.asarray(z, dtype=float),
+                                              a_tilde, b_tilde)
+    args = (z, a_tilde, b_tilde, Ascaling, omega_M_0, omega_lambda_0)
+
+    # Lower / upper brackets on concentration for every halo
+    c_lo = np.ones_like(z) * clim[0]
+    c_hi = np.ones_like(z) * clim[1]
+
+    # Below some concentration the formation redshift has 1 + zf - z < 0,
+    # where the trial function is undefined. From Eqn 17 that is where
+    # rho_2 < Ascaling (z^3 + O_L/O_M) / ((1+z)^3 + O_L/O_M), so bisect
+    # the monotonic rho_2(c) to raise the lower bracket above it
+    ol_om = omega_lambda_0/omega_M_0
+    rho_2_min = Ascaling * (z**3 + ol_om) / ((1 + z)**3 + ol_om)
+    raise_lo = _rho_2(c_lo) <= rho_2_min
+    if np.any(raise_lo):
+        lnc_lo = np.log(c_lo[raise_lo])
+        lnc_hi = np.log(c_hi[raise_lo])
+        for i_iter in range(50):
+            lnc_mid = 0.5 * (lnc_lo + lnc_hi)
+            above = _rho_2(np.exp(lnc_mid)) > rho_2_min[raise_lo]
+            lnc_hi = np.where(above, lnc_mid, lnc_hi)
+            lnc_lo = np.where(above, lnc_lo, lnc_mid)
+        # Keep clear of the edge, where rounding can still leave 1 + zf - z
+        # just below zero
+        c_lo[raise_lo] = np.minimum(np.exp(lnc_hi) * (1 + 1e-9),
+                                    c_hi[raise_lo])
+
+    with np.errstate(invalid='ignore'):
+        f_lo = _minimize_c(c_lo, *args)
+        f_hi = _minimize_c(c_hi, *args)
+
+    # Haloes without a sign change across the bracket have no solution,
+    # so skip iterating on them and return NaN instead
+    c = np.ones_like(z) * np.nan
+    solve = f_lo * f_hi < 0
+    if not np.any(solve):
+        return(c)
+
+    args = (z[solve], a_tilde[solve], b_tilde[solve],
+            Ascaling, omega_M_0, omega_lambda_0)
+    c_lo = c_lo[solve]
+    c_hi = c_hi[solve]
+    f_lo = f_lo[solve]
+
+    # Start from c = 5 unless that is outside the bracket
+    c_solve = np.where((c_lo < 5) & (c_hi > 5), 5., 0.5 * (c_lo + c_hi))
+    for i_iter in range(maxiter):
+        f = _minimize_c(c_solve, *args)
+
+        # Shrink the bracket so it still encloses the root
+        lower = np.sign(f) == np.sign(f_lo)
+        c_lo = np.where(lower, c_solve, c_lo)
+        f_lo = np.where(lower, f, f_lo)
+        c_hi = np.where(lower, c_hi, c_solve)
+
+        # Newton step with a finite difference derivative
+        dc = 1e-7 * c_solve
+        dfdc = (_minimize_c(c_solve + dc, *args) - f) / dc
+        with np.errstate(divide='ignore', invalid='ignore'):
+            c_new = c_solve - f / dfdc
+
+        # Bisect wherever the Newton step leaves the bracket
+        inside = (c_new > c_lo) & (c_new < c_hi)
+        c_new = np.where(inside, c_new, 0.5 * (c_lo + c_hi))
+
+        converged = np.abs(c_new - c_solve) < tol
+        c_solve = c_new
+        if np.all(converged):
+            break
+
+    c[solve] = c_solve
+
+    return(c)
+
+
 def formationz(c, z, Ascaling=900, omega_M_0=0.25, omega_lambda_0=0.75):
     """ Rearrange eqn 18 from Correa et al (2015c) to return
         formation redshift for a concentration at a given redshift
@@ -343,9 +607,8 @@ def formationz(c, z, Ascaling=900, omega_M_0=0.25, omega_lambda_0=0.75):
         Formation redshift for halo of concentration 'c' at redshift 'z'
 
     """
-    Y1 = np.log(2) - 0.5
     Yc = np.log(1+c) - c/(1+c)
-    rho_2 = 200*(c**3)*Y1/Yc
+    rho_2 = 200*(c**3)*_Y1/Yc
 
     zf = (((1+z)**3 + omega_lambda_0/omega_M_0) *
           (rho_2/Ascaling) - omega_lambda_0/omega_M_0)**(1/3) - 1
@@ -353,15 +616,18 @@ def formationz(c, z, Ascaling=900, omega_M_0=0.25, omega_lambda_0=0.75):
     return(zf)
 
 
-def calc_ab(zi, Mi, **cosmo):
+def calc_ab(zi, Mi, retsig=None, **cosmo):
     """ Calculate growth rate indices a_tilde and b_tilde
 
     Parameters
     ----------
-    zi : float
+    zi : float / numpy array
         Redshift
-    Mi : float
-        Halo mass at redshift 'zi'
+    Mi : float / numpy array
+        Halo mass at redshift 'zi'. Must be same size as 'zi' if both arrays
+    retsig : bool, optional
+        Also return the mass variance 'sigma' of mass 'Mi' if retsig = True,
+        default is None.
     cosmo : dict
         Dictionary of cosmological parameters, similar in format to:
         {'N_nu': 0,'Y_He': 0.24, 'h': 0.702, 'n': 0.963,'omega_M_0': 0.275,
@@ -370,7 +636,8 @@ def calc_ab(zi, Mi, **cosmo):
 
     Returns
     -------
-    (a_tilde, b_tilde) : float
+    (a_tilde, b_tilde) : float / numpy arrays
+    (a_tilde, b_tilde, sig) : float / numpy arrays if retsig = True
     """
 
     # When zi = 0, the a_tilde becomes alpha and b_tilde becomes beta
@@ -388,8 +655,8 @@ def calc_ab(zi, Mi, **cosmo):
     Rq_Mass = cp.perturbation.mass_to_radius(Mi/q, **cosmo)  # [Mpc]
 
     # Mass variance 'sigma' evaluate at z=0 to a good approximation
-    sig, err_sig = cp.perturbation.sigma_r(R_Mass, 0, **cosmo)  # [Mpc]
-    sigq, err_sigq = cp.perturbation.sigma_r(Rq_Mass, 0, **cosmo)  # [Mpc]
+    sig = _sigma_r0(R_Mass, **cosmo)
+    sigq = _sigma_r0(Rq_Mass, **cosmo)
 
     f = (sigq**2 - sig**2)**(-0.5)
 
@@ -401,21 +668,30 @@ def calc_ab(zi, Mi, **cosmo):
     # b_tilde is exponential growth rate
     b_tilde = -f
 
-    return(a_tilde, b_tilde)
+    if retsig:
+        return(a_tilde, b_tilde, sig)
+    else:
+        return(a_tilde, b_tilde)
 
 
-def acc_rate(z, zi, Mi, **cosmo):
+def acc_rate(z, zi, Mi, a_tilde=None, b_tilde=None, E2=None, **cosmo):
     """ Calculate accretion rate and mass history of a halo at any
         redshift 'z' with mass 'Mi' at a lower redshift 'z'
 
     Parameters
     ----------
-    z : float
+    z : float / numpy array
         Redshift to solve acc_rate / mass history. Note zi<z
     zi : float
         Redshift
     Mi : float
         Halo mass at redshift 'zi'
+    a_tilde, b_tilde : float, optional
+        Growth rate indices of the halo from calc_ab, computed from 'zi'
+        and 'Mi' if not provided. Default is None.
+    E2 : float / numpy array, optional
+        Squared dimensionless Hubble rate omega_M_0*(1+z)**3 + omega_lambda_0
+        at 'z', if already known. Default is None, calculated here.
     cosmo : dict
         Dictionary of cosmological parameters, similar in format to:
         {'N_nu': 0,'Y_He': 0.24, 'h': 0.702, 'n': 0.963,'omega_M_0': 0.275,
@@ -424,30 +700,35 @@ def acc_rate(z, zi, Mi, **cosmo):
 
     Returns
     -------
-    (dMdt, Mz) : float
+    (dMdt, Mz) : float / numpy arrays of equivalent size to 'z'
         Accretion rate [Msol/yr], halo mass [Msol] at redshift 'z'
 
     """
     # Find parameters a_tilde and b_tilde for initial redshift
     # use Eqn 9 and 10 of Correa et al. (2015c)
-    a_tilde, b_tilde = calc_ab(zi, Mi, **cosmo)
+    if a_tilde is None or b_tilde is None:
+        a_tilde, b_tilde = calc_ab(zi, Mi, **cosmo)
+
+    # Redshift step(s) away from the starting redshift
+    dz = z - zi
 
     # Halo mass at z, in Msol
     # use Eqn 8 in Correa et al. (2015c)
-    Mz = Mi * ((1 + z - zi)**a_tilde) * (np.exp(b_tilde * (z - zi)))
+    Mz = Mi * ((1 + dz)**a_tilde) * (np.exp(b_tilde * dz))
 
     # Accretion rate at z, Msol yr^-1
     # use Eqn 11 from Correa et al. (2015c)
+    if E2 is None:
+        E2 = cosmo['omega_M_0']*(1 + z)**3 + cosmo['omega_lambda_0']
     dMdt = 71.6 * (Mz/1e12) * (cosmo['h']/0.7) *\
-        (-a_tilde / (1 + z - zi) - b_tilde) * (1 + z) *\
-        np.sqrt(cosmo['omega_M_0']*(1 + z)**3+cosmo['omega_lambda_0'])
+        (-a_tilde / (1 + dz) - b_tilde) * (1 + z) * np.sqrt(E2)
 
     return(dMdt, Mz)
 
 
-def MAH(z, zi, Mi, **cosmo):
-    """ Calculate mass accretion history by looping function acc_rate
-        over redshift steps 'z' for halo of mass 'Mi' at redshift 'zi'
+def MAH(z, zi, Mi, a_tilde=None, b_tilde=None, E2=None, **cosmo):
+    """ Calculate mass accretion history by evaluating function acc_rate
+        across all redshift steps 'z' for halo of mass 'Mi' at redshift 'zi'
 
     Parameters
     ----------
@@ -457,6 +738,12 @@ def MAH(z, zi, Mi, **cosmo):
         Redshift
     Mi : float
         Halo mass at redshift 'zi'
+    a_tilde, b_tilde : float, optional
+        Growth rate indices of the halo from calc_ab, computed from 'zi'
+        and 'Mi' if not provided. Default is None.
+    E2 : float / numpy array, optional
+        Squared dimensionless Hubble rate omega_M_0*(1+z)**3 + omega_lambda_0
+        at 'z', if already known. Default is None, calculated here.
     cosmo : dict
         Dictionary of cosmological parameters, similar in format to:
         {'N_nu': 0,'Y_He': 0.24, 'h': 0.702, 'n': 0.963,'omega_M_0': 0.275,
@@ -471,23 +758,17 @@ def MAH(z, zi, Mi, **cosmo):
     """
 
     # Ensure that z is a 1D NumPy array
-    z = np.array(z, ndmin=1, dtype=float)
-
-    # Create a full array
-    dMdt_array = np.empty_like(z)
-    Mz_array = np.empty_like(z)
+    z = _as1d(z)
 
-    for i_ind, zval in enumerate(z):
-        # Solve the accretion rate and halo mass at each redshift step
-        dMdt, Mz = acc_rate(zval, zi, Mi, **cosmo)
-
-        dMdt_array[i_ind] = dMdt
-        Mz_array[i_ind] = Mz
+    # Solve the accretion rate and halo mass at all redshift steps at once,
+    # a_tilde and b_tilde only depend on the starting redshift and mass
+    dMdt_array, Mz_array = acc_rate(z, zi, Mi, a_tilde=a_tilde,
+                                    b_tilde=b_tilde, E2=E2, **cosmo)
 
     return(dMdt_array, Mz_array)
 
 
-def COM(z, M, **cosmo):
+def COM(z, M, E2=None, **cosmo):
     """ Calculate concentration for halo of mass 'M' at redshift 'z'
 
     Parameters
@@ -496,6 +777,9 @@ def COM(z, M, **cosmo):
         Redshift to find concentration of halo
     M : float / numpy array
         Halo mass at redshift 'z'. Must be same size as 'z'
+    E2 : float / numpy array, optional
+        Squared dimensionless Hubble rate omega_M_0*(1+z)**3 + omega_lambda_0
+        at 'z', if already known. Default is None, calculated here.
     cosmo : dict
         Dictionary of cosmological parameters, similar in format to:
         {'N_nu': 0,'Y_He': 0.24, 'h': 0.702, 'n': 0.963,'omega_M_0': 0.275,
@@ -511,56 +795,63 @@ def COM(z, M, **cosmo):
 
     """
     # Check that z and M are arrays
-    z = np.array(z, ndmin=1, dtype=float)
-    M = np.array(M, ndmin=1, dtype=float)
-
-    # Create array
-    c_array = np.empty_like(z)
-    sig_array = np.empty_like(z)
-    nu_array = np.empty_like(z)
-    zf_array = np.empty_like(z)
-
-    for i_ind, (zval, Mval) in enumerate(_izip(z, M)):
-        # Evaluate the indices at each redshift and mass combination
-        # that you want a concentration for, different to MAH which
-        # uses one a_tilde and b_tilde at the starting redshift only
-        a_tilde, b_tilde = calc_ab(zval, Mval, **cosmo)
-
-        # Minimize equation to solve for 1 unknown, 'c'
-        c = scipy.optimize.brentq(_minimize_c, 2, 1000,
-                                  args=(zval, a_tilde, b_tilde,
-                                        cosmo['A_scaling'], cosmo['omega_M_0'],
-                                        cosmo['omega_lambda_0']))
-
-        if np.isclose(c, 0):
-            print("Error solving for concentration with given redshift and "
-                  "(probably) too small a mass")
-            c = -1
-            sig = -1
-            nu = -1
-            zf = -1
-        else:
-            # Calculate formation redshift for this concentration,
-            # redshift at which the scale radius = virial radius: z_-2
-            zf = formationz(c, zval, Ascaling=cosmo['A_scaling'],
-                            omega_M_0=cosmo['omega_M_0'],
-                            omega_lambda_0=cosmo['omega_lambda_0'])
+    z = _as1d(z)
+    M = _as1d(M)
+
+    # Evaluate the indices at each redshift and mass combination
+    # that you want a concentration for, different to MAH which
+    # uses one a_tilde and b_tilde at the starting redshift only
+    # along with the mass variance 'sigma' of each halo
+    a_tilde, b_tilde, sig_array = calc_ab(z, M, retsig=True, **cosmo)
+
+    nu_array = 1.686/(sig_array*growthfactor(z, norm=True, E2=E2, **cosmo))
+
+    # Minimize equation to solve for 1 unknown, 'c', for all haloes at once
+    c_array = _solve_c(z, a_tilde, b_tilde, Ascaling=cosmo['A_scaling'],
+                       omega_M_0=cosmo['omega_M_0'],
+                       omega_lambda_0=cosmo['omega_lambda_0'])
+
+    # Formation redshift for this concentration is a by-product of the
+    # trial function, redshift at which the scale radius = virial radius: z_-2
+    residual, zf_array = _minimize_c(c_array, z, a_tilde, b_tilde,
+                                     cosmo['A_scaling'], cosmo['omega_M_0'],
+                                     cosmo['omega_lambda_0'], return_zf=True)
+
+    # Haloes without a root in the concentration bracket get flagged
+    failed = np.isnan(c_array) | ~np.isclose(residual, 0)
+    if np.any(failed):
+        print("Error solving for concentration with given redshift and "
+              "(probably) too small a mass")
+        c_array[failed] = -1
+        sig_array[failed] = -1
+        nu_array[failed] = -1
+        zf_array[failed] = -1
 
-            R_Mass = cp.perturbation.mass_to_radius(Mval, **cosmo)
+    return(c_array, sig_array, nu_array, zf_array)
 
-            sig, err_sig = cp.perturbation.sigma_r(R_Mass, 0, **cosmo)
-            nu = 1.686/(sig*growthfactor(zval, norm=True, **cosmo))
 
-        c_array[i_ind] = c
-        sig_array[i_ind] = sig
-        nu_array[i_ind] = nu
-        zf_array[i_ind] = zf
+def _run_halo(args):
+    """ Accretion history, and concentrations if com is True, of one halo
+        for run(), at module level so that it can be sent to a process pool """
 
-    return(c_array, sig_array, nu_array, zf_array)
+    ztemp, zval, Mval, a_tilde, b_tilde, E2, com, cosmo = args
+
+    # Return accretion rates and halo mass progenitors at
+    # redshifts 'z' for object of mass Mi at zi
+    dMdt, Mz = MAH(ztemp, zval, Mval, a_tilde=a_tilde, b_tilde=b_tilde,
+                   E2=E2, **cosmo)
+    if com:
+        # More expensive to return concentrations
+        # For any halo mass Mi at redshift zi
+        # solve for c, sig, nu and zf
+        c, sig, nu, zf = COM(ztemp, Mz, E2=E2, **cosmo)
+        return(dMdt, Mz, c, sig, nu, zf)
+    else:
+        return(dMdt, Mz)
 
 
 def run(cosmology, zi=0, Mi=1e12, z=False, com=True, mah=True,
-        filename=None, verbose=None, retcosmo=None):
+        filename=None, verbose=None, retcosmo=None, ncores=1, out=None):
     """ Run commah code on halo of mass 'Mi' at redshift 'zi' with
         accretion and profile history at higher redshifts 'z'
         This is based on Correa et al. (2015a,b,c)
@@ -599,13 +890,25 @@ def run(cosmology, zi=0, Mi=1e12, z=False, com=True, mah=True,
     mah : bool, optional
         If true then solve for accretion rate and halo mass history,
         default is True.
-    filename : bool / str, optional
-        If str is passed this is used as a filename for output of commah
+    filename : bool / str / path, optional
+        If str or path is passed this is used as a filename for output of
+        commah, written as text unless the name ends in '.npy', in which
+        case the structured dataset is saved in NumPy binary format
     verbose : bool, optional
         If true then give comments, default is None.
     retcosmo : bool, optional
         Return cosmological parameters used as a dict if retcosmo = True,
         default is None.
+    ncores : int, optional
+        Number of processes to share the haloes between, default is 1.
+        For ncores > 1 on platforms that start processes by spawning
+        (Windows, macOS) the calling script must protect its entry point
+        with if __name__ == '__main__':
+    out : structured dataset, optional
+        Dataset to fill in place and return instead of allocating a new one,
+        e.g. from an earlier call with the same arguments. Must have the
+        shape and columns of the dataset that would be returned.
+        Default is None.
 
     Returns
     -------
@@ -641,6 +944,10 @@ def run(cosmology, zi=0, Mi=1e12, z=False, com=True, mah=True,
     Output -1
         If 'zi' and 'Mi' are arrays of unequal size. Impossible to match
         corresponding masses and redshifts of output.
+    Output -1
+        If 'ncores' is not a whole number of at least 1.
+    Output -1
+        If 'out' does not match the shape or columns of the output.
 
     Examples
     --------
@@ -657,6 +964,11 @@ def run(cosmology, zi=0, Mi=1e12, z=False, com=True, mah=True,
     if not com and not mah:
         print("User has to choose com=True and / or mah=True ")
         return(-1)
+    if not isinstance(ncores, numbers.Integral) or isinstance(ncores, bool) \
+            or ncores < 1:
+        print("Number of processes ncores has to be a whole number of at "
+              "least 1, you gave %r" % (ncores,))
+        return(-1)
 
     # Convert arrays / lists to np.array
     # and inflate redshift / mass axis
@@ -674,18 +986,46 @@ def run(cosmology, zi=0, Mi=1e12, z=False, com=True, mah=True,
     # Get the cosmological parameters for the given cosmology
     cosmo = getcosmo(cosmology)
 
-    # Create  output file if desired
+    # Columns of the structured dataset for the output requested
+    if mah and com:
+        dtype = [('zi', float), ('Mi', float), ('z', float), ('dMdt', float),
+                 ('Mz', float), ('c', float), ('sig', float), ('nu', float),
+                 ('zf', float)]
+    elif mah:
+        dtype = [('zi', float), ('Mi', float), ('z', float), ('dMdt', float),
+                 ('Mz', float)]
+    else:
+        dtype = [('zi', float), ('Mi', float), ('z', float), ('c', float),
+                 ('sig', float), ('nu', float), ('zf', float)]
+
+    # Fill the dataset passed in by the user rather than make a new one
+    if out is None:
+        dataset = np.zeros((lenm, lenzout), dtype=dtype)
+    elif out.shape != (lenm, lenzout) or out.dtype != np.dtype(dtype):
+        print("Dataset 'out' must have shape %s and columns %s" %
+              ((lenm, lenzout), np.dtype(dtype).names))
+        return(-1)
+    else:
+        dataset = out
+        dataset[...] = 0
+
+    # Create  output file if desired, text unless a NumPy .npy is asked for
+    npyout = bool(filename) and str(filename).endswith('.npy')
+    textout = bool(filename) and not npyout
     if filename:
         print("Output to file %r" % (filename))
-        fout = open(filename, 'w')
+    if textout:
+        fout = open(filename, 'w', 1 << 20)
 
-    # Create the structured dataset
+    pool = None
+
+    # Write the header of the output requested
     try:
         if mah and com:
             if verbose:
                 print("Output requested is zi, Mi, z, dMdt, Mz, c, sig, nu, "
                       "zf")
-            if filename:
+            if textout:
                 fout.write(_getcosmoheader(cosmo)+'\n')
                 fout.write("# Initial z - Initial Halo  - Output z - "
                            " Accretion -  Final Halo  - concentration - "
@@ -699,14 +1039,10 @@ def run(cosmology, zi=0, Mi=1e12, z=False, com=True, mah=True,
                 fout.write("#           -    [Msol]     -          - "
                            " [Msol/yr] -    [Msol]    -               - "
                            "           -            -              "+'\n')
-            dataset = np.zeros((lenm, lenzout), dtype=[('zi', float),
-                               ('Mi', float), ('z', float), ('dMdt', float),
-                               ('Mz', float), ('c', float), ('sig', float),
-                               ('nu', float), ('zf', float)])
         elif mah:
             if verbose:
                 print("Output requested is zi, Mi, z, dMdt, Mz")
-            if filename:
+            if textout:
                 fout.write(_getcosmoheader(cosmo)+'\n')
                 fout.write("# Initial z - Initial Halo  - Output z -"
                            "   Accretion - Final Halo "+'\n')
@@ -716,13 +1052,10 @@ def run(cosmology, zi=0, Mi=1e12, z=False, com=True, mah=True,
                            "    (dm/dt)  -  (M200)    "+'\n')
                 fout.write("#           -    [Msol]     -          -"
                            "   [Msol/yr] -  [Msol]    "+'\n')
-            dataset = np.zeros((lenm, lenzout), dtype=[('zi', float),
-                               ('Mi', float), ('z', float),
-                               ('dMdt', float), ('Mz', float)])
         else:
             if verbose:
                 print("Output requested is zi, Mi, z, c, sig, nu, zf")
-            if filename:
+            if textout:
                 fout.write(_getcosmoheader(cosmo)+'\n')
                 fout.write("# Initial z - Initial Halo  - Output z - "
                            " concentration - "
@@ -736,69 +1069,95 @@ def run(cosmology, zi=0, Mi=1e12, z=False, com=True, mah=True,
                 fout.write("#           -   [Msol]      -          - "
                            "               - "
                            "          -            -            "+'\n')
-            dataset = np.zeros((lenm, lenzout), dtype=[('zi', float),
-                               ('Mi', float), ('z', float), ('c', float),
-                               ('sig', float), ('nu', float), ('zf', float)])
 
-        # Now loop over the combination of initial redshift and halo mamss
-        for i_ind, (zval, Mval) in enumerate(_izip(zi, Mi)):
-            if verbose:
-                print("Output Halo of Mass Mi=%s at zi=%s" % (Mval, zval))
+        # Growth rate indices of all haloes at their starting redshifts
+        a_tilde, b_tilde = calc_ab(zi, Mi, **cosmo)
+
+        # Text output format of a row of the dataset
+        rowfmt = ", ".join(["%.7g"] * len(dataset.dtype.names)) + " \n"
+
+        # Output redshifts (and Hubble rate term) for each starting
+        # redshift, and the first index of each halo already solved for
+        zcache = {}
+        solved = {}
+        ztemps = []
+        tasks = []
+
+        # Find the output redshifts of each combination of initial redshift
+        # and halo mass, and which haloes have to be solved for
+        for i_ind, (zval, Mval) in enumerate(zip(zi, Mi)):
             # For a given halo mass Mi at redshift zi need to know
             # output redshifts 'z'
             # Check that all requested redshifts are greater than
             # input redshift, except if z is False, in which case
             # only solve z at zi, i.e. remove a loop
-            if z is False:
-                ztemp = np.array(zval, ndmin=1, dtype=float)
-            else:
-                ztemp = np.array(z[z >= zval], dtype=float)
-
-            # Loop over the output redshifts
-            if ztemp.size:
-                # Return accretion rates and halo mass progenitors at
-                # redshifts 'z' for object of mass Mi at zi
-                dMdt, Mz = MAH(ztemp, zval, Mval, **cosmo)
-                if mah and com:
-                    # More expensive to return concentrations
-                    c, sig, nu, zf = COM(ztemp, Mz, **cosmo)
-                    # Save all arrays
-                    for j_ind, j_val in enumerate(ztemp):
-                        dataset[i_ind, j_ind] =\
-                            (zval, Mval, ztemp[j_ind], dMdt[j_ind], Mz[j_ind],
-                             c[j_ind], sig[j_ind], nu[j_ind], zf[j_ind])
-                        if filename:
-                            fout.write(
-                                "{}, {}, {}, {}, {}, {}, {}, {}, {} \n".format(
-                                    zval, Mval, ztemp[j_ind], dMdt[j_ind],
-                                    Mz[j_ind], c[j_ind], sig[j_ind], nu[j_ind],
-                                    zf[j_ind]))
-                elif mah:
-                    # Save only MAH arrays
-                    for j_ind, j_val in enumerate(ztemp):
-                        dataset[i_ind, j_ind] =\
-                            (zval, Mval, ztemp[j_ind], dMdt[j_ind], Mz[j_ind])
-                        if filename:
-                            fout.write("{}, {}, {}, {}, {} \n".format(
-                                zval, Mval, ztemp[j_ind], dMdt[j_ind],
-                                Mz[j_ind]))
+            if zval not in zcache:
+                if z is False:
+                    ztemp = _as1d(zval)
                 else:
-                    # Output only COM arrays
-                    c, sig, nu, zf = COM(ztemp, Mz, **cosmo)
-                    # For any halo mass Mi at redshift zi
-                    # solve for c, sig, nu and zf
-                    for j_ind, j_val in enumerate(ztemp):
-                        dataset[i_ind, j_ind] =\
-                            (zval, Mval, ztemp[j_ind], c[j_ind], sig[j_ind],
-                             nu[j_ind], zf[j_ind])
-                        if filename:
-                            fout.write("{}, {}, {}, {}, {}, {}, {} \n".format(
-                                zval, Mval, ztemp[j_ind], c[j_ind], sig[j_ind],
-                                nu[j_ind], zf[j_ind]))
+                    ztemp = z[z >= zval]
+                # Hubble rate term shared by the MAH and COM calculations
+                E2 = cosmo['omega_M_0']*(1 + ztemp)**3 +\
+                    cosmo['omega_lambda_0']
+                # Shared by every halo starting at zval, so guard against
+                # any of them changing it in place
+                ztemp.flags.writeable = False
+                E2.flags.writeable = False
+                zcache[zval] = (ztemp, E2)
+            ztemp, E2 = zcache[zval]
+            ztemps.append(ztemp)
+
+            if ztemp.size and (zval, Mval) not in solved:
+                solved[(zval, Mval)] = i_ind
+                tasks.append((ztemp, zval, Mval, a_tilde[i_ind],
+                              b_tilde[i_ind], E2, com, cosmo))
+
+        # Solve the haloes, shared between processes if asked for
+        if ncores > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(ncores)
+            results = pool.imap(_run_halo, tasks,
+                                max(1, len(tasks) // (4 * ncores)))
+        else:
+            results = (_run_halo(task) for task in tasks)
+
+        # Now loop over the combination of initial redshift and halo mamss
+        for i_ind, (zval, Mval) in enumerate(zip(zi, Mi)):
+            if verbose:
+                print("Output Halo of Mass Mi=%s at zi=%s" % (Mval, zval))
+            ztemp = ztemps[i_ind]
+            if not ztemp.size:
+                continue
+
+            if solved[(zval, Mval)] != i_ind:
+                # Same halo as before, so copy its output
+                dataset[i_ind] = dataset[solved[(zval, Mval)]]
+            else:
+                result = next(results)
+                # Fill the output redshifts of this halo a field at a time
+                row = dataset[i_ind, :ztemp.size]
+                row['zi'] = zval
+                row['Mi'] = Mval
+                row['z'] = ztemp
+                if mah:
+                    # Save MAH arrays
+                    row['dMdt'], row['Mz'] = result[:2]
+                if com:
+                    # Save COM arrays
+                    row['c'], row['sig'], row['nu'], row['zf'] = result[2:]
+
+            if textout:
+                # Write all output redshifts for this halo in one block
+                fout.write("".join([
+                    rowfmt % rowval
+                    for rowval in dataset[i_ind, :ztemp.size].tolist()]))
 
     # Make sure to close the file if it was opened
     finally:
-        fout.close() if filename else None
+        fout.close() if textout else None
+        pool.terminate() if pool else None
+
+    if npyout:
+        np.save(str(filename), dataset)
 
     if retcosmo:
         return(dataset, cosmo)
@@ -11,6 +11,9 @@ Tests for `commah` module.
 from __future__ import absolute_import, division, print_function
 
 import numpy as np
+import scipy.integrate
+import scipy.optimize
+import cosmolopy
 import commah
 
 
@@ -19,13 +22,13 @@ class TestCommah(object):
         cosmolist = ['WMAP1', 'WMAP3', 'WMAP5',
                      'WMAP7', 'WMAP9',
                      'Planck13', 'Planck15']
-        conclist = [8.84952005507872,
-                    6.570929526400634,
-                    7.663081978810533,
-                    7.906741464320479,
-                    8.883912548303279,
-                    9.250262507139139,
-                    9.044999285760362]
+        conclist = [8.945808155009658,
+                    6.63818218534302,
+                    7.764236787502424,
+                    7.990693857745733,
+                    8.978808173684323,
+                    9.374842668821628,
+                    9.165855703325503]
         for ival, cosmo in enumerate(cosmolist):
             output = commah.run(cosmo, Mi=[1e12], verbose=True)
             assert(np.allclose(output['c'].flatten()[0],
@@ -33,12 +36,137 @@ class TestCommah(object):
 
     def test_evolution(self):
         zlist = np.array([0, 1, 2])
-        conclist = np.array([7.66308, 5.70009, 4.55295])
+        conclist = np.array([7.76424, 5.76206, 4.59351])
         output = commah.run('WMAP5', zi=[0], Mi=[1e12], z=zlist)
         assert(np.allclose(output['c'].flatten(), conclist, rtol=1e-3))
 
     def test_startingz(self):
         zlist = np.array([0, 1, 2])
-        conclist = np.array([4.55295, 4.43175, 4.26342])
+        conclist = np.array([4.59351, 4.47005, 4.29829])
         output = commah.run('WMAP5', zi=zlist, Mi=[1e12], z=2)
         assert(np.allclose(output['c'].flatten(), conclist, rtol=1e-3))
+
+    def test_cduffy(self):
+        Mpivot = 2e12/0.72
+        conclist = np.array([6.71, 6.71*2**-0.44, 6.71*10**-0.091])
+        output = commah.commah.cduffy(np.array([0, 1, 0]),
+                                      np.array([1, 1, 10])*Mpivot)
+        assert(np.allclose(output, conclist))
+        assert(np.isclose(commah.commah.cduffy(0, Mpivot, vir='tophat',
+                                               relaxed=False), 7.85))
+
+    def test_npyfile(self, tmpdir):
+        filename = str(tmpdir.join('commah_test.npy'))
+        output = commah.run('WMAP5', zi=[0], Mi=[1e12], z=[0, 1, 2],
+                            filename=filename)
+        saved = np.load(filename)
+        assert(saved.dtype == output.dtype)
+        assert(np.array_equal(saved['c'], output['c']))
+        # Path objects rather than strings, for both kinds of output
+        commah.run('WMAP5', zi=[0], Mi=[1e12], filename=tmpdir.join('c.npy'))
+        commah.run('WMAP5', zi=[0], Mi=[1e12], filename=tmpdir.join('c.txt'))
+        assert(tmpdir.join('c.npy').check() and tmpdir.join('c.txt').check())
+
+    def test_ncores(self):
+        Mlist = np.array([1e9, 1e11, 1e13])
+        serial = commah.run('WMAP5', zi=0, Mi=Mlist, z=[0, 1, 2])
+        pooled = commah.run('WMAP5', zi=0, Mi=Mlist, z=[0, 1, 2], ncores=2)
+        assert(np.array_equal(serial, pooled))
+        for ncores in (None, 0, -2, 1.5):
+            assert(commah.run('WMAP5', zi=0, Mi=Mlist, ncores=ncores) == -1)
+
+    def test_out(self):
+        Mlist = np.array([1e9, 1e11, 1e13])
+        output = commah.run('WMAP5', zi=0, Mi=Mlist, z=[0, 1, 2])
+        buf = np.ones_like(output)
+        filled = commah.run('WMAP5', zi=0, Mi=Mlist, z=[0, 1, 2], out=buf)
+        assert(filled is buf)
+        assert(np.array_equal(filled, output))
+        assert(commah.run('WMAP5', zi=0, Mi=Mlist, z=[0, 1], out=buf) == -1)
+
+    def test_reuse_cosmo(self):
+        cosmo = {'omega_M_0': 0.3, 'omega_lambda_0': 0.7, 'omega_b_0': 0.045,
+                 'h': 0.7, 'n': 0.96, 'sigma_8': 0.8}
+        low = commah.run(cosmo, zi=0, Mi=1e12)
+        assert('deltaSqr' not in cosmo)
+        cosmo['sigma_8'] = 0.9
+        high = commah.run(cosmo, zi=0, Mi=1e12)
+        assert(not np.allclose(low['c'], high['c']))
+
+    def test_unhashable_cosmo(self):
+        cosmo = {'omega_M_0': 0.3, 'omega_lambda_0': 0.7, 'omega_b_0': 0.045,
+                 'h': 0.7, 'n': 0.96, 'sigma_8': 0.8}
+        output = commah.run(dict(cosmo), zi=0, Mi=1e12)
+        cosmo['h'] = np.array(0.7)
+        unhashable = commah.run(cosmo, zi=0, Mi=1e12)
+        assert(np.allclose(unhashable['c'], output['c']))
+
+    def test_edit_cosmo(self):
+        cosmo = commah.getcosmo('WMAP5')
+        assert('deltaSqr' not in cosmo)
+        low = commah.run(dict(cosmo), zi=0, Mi=1e12)
+        cosmo['sigma_8'] = 0.9
+        high = commah.run(cosmo, zi=0, Mi=1e12)
+        assert(np.allclose(high['sig']/low['sig'], 0.9/0.796, rtol=1e-3))
+
+    def test_cosmo_cache(self):
+        cosmo = {'omega_M_0': 0.32, 'omega_lambda_0': 0.68,
+                 'omega_b_0': 0.045, 'h': 0.7, 'n': 0.96, 'sigma_8': 0.8}
+        cache = commah.commah._getcosmo_cached.cache
+        commah.getcosmo(cosmo)
+        ncached = len(cache)
+        commah.getcosmo(cosmo)
+        assert(len(cache) == ncached)
+
+    def test_solve_c(self):
+        cosmo = commah.getcosmo('WMAP5')
+        args = (cosmo['A_scaling'], cosmo['omega_M_0'],
+                cosmo['omega_lambda_0'])
+        zgrid, Mgrid = np.meshgrid([0, 2, 7, 14, 20, 30], [1e8, 1e11, 1e14])
+        zgrid, Mgrid = zgrid.flatten(), Mgrid.flatten()
+        a_tilde, b_tilde = commah.commah.calc_ab(zgrid, Mgrid, **cosmo)
+        c = commah.commah._solve_c(zgrid, a_tilde, b_tilde, *args)
+        # Bracket each root on a fine grid, skipping where the trial
+        # function is undefined, then compare against brentq
+        cgrid = np.logspace(np.log10(2), 3, 4000)
+        for i in range(zgrid.size):
+            fargs = (zgrid[i], a_tilde[i], b_tilde[i]) + args
+            with np.errstate(invalid='ignore'):
+                f = commah.commah._minimize_c(cgrid, *fargs)
+            change = np.where(f[:-1] * f[1:] < 0)[0]
+            root = scipy.optimize.brentq(commah.commah._minimize_c,
+                                         cgrid[change[0]],
+                                         cgrid[change[0]+1],
+                                         args=fargs, xtol=1e-12)
+            assert(np.isclose(c[i], root, rtol=1e-6))
+
+    def test_no_concentration(self):
+        # No concentration in the bracket can reach so high a density
+        cosmo = commah.getcosmo('WMAP5')
+        cosmo['A_scaling'] = 1e9
+        output = commah.commah.COM([0, 1], [1e12, 1e12], **cosmo)
+        assert(np.all(np.array(output) == -1))
+
+    def test_sigma(self):
+        cosmo = commah.getcosmo('WMAP5')
+        R8 = 8/cosmo['h']
+        sigma = commah.commah._sigma_r0
+        assert(np.isclose(sigma(R8, **cosmo), cosmo['sigma_8'], rtol=1e-4))
+
+        # Shape against adaptive quadrature, normalisation divided out
+        unnormed = dict(cosmo, deltaSqr=1)
+
+        def sig2(R):
+            def integrand(lnk):
+                k = np.exp(lnk)
+                W = 3 * (np.sin(k*R) - k*R * np.cos(k*R)) / (k*R)**3
+                return(cosmolopy.perturbation.power_spectrum(
+                    k, 0.0, **unnormed) * k**3 * W**2)
+            return(scipy.integrate.quad(integrand, np.log(1e-6),
+                                        np.log(1e4/R), limit=1000,
+                                        epsabs=0, epsrel=1e-10)[0])
+
+        Rlist = np.array([0.01, 0.1, 1, 10, 50])
+        ratio = np.sqrt([sig2(R)/sig2(R8) for R in Rlist])
+        assert(np.allclose(sigma(Rlist, **cosmo)/sigma(R8, **cosmo), ratio,
+                           rtol=1e-6))